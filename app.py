@@ -1,18 +1,67 @@
+import contextlib
+import functools
+import hashlib
+import http.cookiejar
+import json
+import multiprocessing
 import os
+import re
 import shutil
+import subprocess
+import sys
 import tempfile
 import threading
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qsl, quote, urlencode, urlparse, urlunparse
 
 from flask import (
-    Flask, render_template, request, jsonify,
-    send_file, after_this_request
+    Flask, Response, render_template, request, jsonify, send_file
 )
+from flask.json.provider import DefaultJSONProvider
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
 from yt_dlp import YoutubeDL, DownloadError
+from yt_dlp.cookies import YoutubeDLCookieJar
+
+try:
+    import orjson  # optional: faster JSON for the /progress polling hot path
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson; jsonify() call sites stay the same."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get("indent"):
+            # Pretty output (debug mode) keeps the stdlib encoder
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.secret_key = "dev"  # change in production
 
+# Number of reverse proxies in front of the app (PaaS router, nginx, ...).
+# Their X-Forwarded-* headers are trusted so the client IP (used for rate
+# limiting) is the real one, not the proxy's. Leave 0 when exposed directly.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES,
+                            x_host=TRUSTED_PROXIES)
+
 # Branding (your credit)
 DEV_NAME = os.environ.get("DEV_NAME", "bodruddozaredoy")
 DEV_URL  = os.environ.get("DEV_URL",  "https://www.devredoy.com/")
@@ -39,18 +88,329 @@ if not COOKIES_FILE:
             COOKIES_FILE = cand
             break
 
+# Hosts we accept video URLs from (comma-separated override via ALLOWED_HOSTS)
+ALLOWED_HOSTS = frozenset(
+    h.strip().lower() for h in os.environ.get(
+        "ALLOWED_HOSTS", "youtube.com,www.youtube.com,m.youtube.com,music.youtube.com,youtu.be"
+    ).split(",") if h.strip()
+)
+_URL_RE = re.compile(r"^https?://[^\s/$.?#].[^\s]*$", re.IGNORECASE)
+_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_VIDEO_PATH_RE = re.compile(r"^/(?:shorts|embed|live|v)/([^/?#]+)")
+# Query parameters that don't change what gets downloaded
+_TRACKING_PARAMS = frozenset(("si", "feature", "pp", "t", "start", "ab_channel"))
+
 # Optional: YouTube client selection to reduce friction on some videos
 # Comma-separated list. Common picks: android,web,ios
 YTDLP_PLAYER_CLIENT = os.environ.get("YTDLP_PLAYER_CLIENT", "android,web")
 
-# In-memory progress state
-PROGRESS = {}  # job_id -> dict(status, percent, speed, eta, msg, tmpdir, final_path, error, filename)
+# Optional: Redis URL for shared job state, e.g. redis://localhost:6379/0
+# Needed when running several worker processes (gunicorn -w N); requires the
+# `redis` package. Without it, job state lives in this process only.
+REDIS_URL = os.environ.get("REDIS_URL")
+
+# Concurrent downloads, and how many jobs (running + queued) we accept before
+# answering /start with 429
+YTDL_WORKERS = int(os.environ.get("YTDL_WORKERS", "4"))
+YTDL_MAX_PENDING = int(os.environ.get("YTDL_MAX_PENDING", str(YTDL_WORKERS * 4)))
+
+# Optional: run downloads in this many child processes instead of threads, so
+# yt-dlp's CPU work doesn't hold the GIL of the process serving requests. If a
+# child dies, the jobs it was running fail and the pool is recreated.
+# 0 (default) keeps the thread pool.
+YTDL_PROCS = int(os.environ.get("YTDL_PROCS", "0"))
+
+# True in the app's own process; False in download child processes, which
+# import this module too and must not start their own pools/threads
+IS_MAIN_PROCESS = multiprocessing.parent_process() is None
+
+# Per-client-IP limit on new downloads, shared by /start and /stream
+# (flask-limiter syntax). Counters live in Redis when REDIS_URL is set, so the
+# limit holds across worker processes.
+START_RATE_LIMIT = os.environ.get("START_RATE_LIMIT", "3/minute;60/hour")
+
+# Seconds a client is told to wait (Retry-After) when the download queue is full
+QUEUE_FULL_RETRY_AFTER = 10
+
+# Block size for /stream (bytes)
+STREAM_CHUNK = 64 * 1024
+
+# Minimum interval between progress updates while downloading (seconds).
+# yt-dlp calls the hook for every chunk; the UI only needs a few updates/sec.
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "0.2"))
+
+# Longest time /progress?wait=N holds a request waiting for a change (seconds)
+LONG_POLL_MAX = float(os.environ.get("LONG_POLL_MAX", "5"))
+# At most this many /progress requests wait at once; each holds a server thread.
+# The rest answer right away, so long-polls can't starve other requests.
+LONG_POLL_CLIENTS = int(os.environ.get("LONG_POLL_CLIENTS", "8"))
+
+# How long an unfinished job is kept once nothing updates it anymore, e.g.
+# because the process running it died (seconds). Jobs this process is still
+# queueing or downloading are refreshed every HEARTBEAT_INTERVAL.
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))
+HEARTBEAT_INTERVAL = 10
+# An unfinished job whose heartbeat stopped this long ago lost its process;
+# new requests start over instead of joining it (seconds)
+STALE_AFTER = HEARTBEAT_INTERVAL * 6
+# Finished/failed jobs and their files are kept this long after they end, so
+# downloads can be resumed and shared (seconds)
+DONE_TTL = int(os.environ.get("DONE_TTL", "600"))
+JANITOR_INTERVAL = 60
+
+TMP_PREFIX = "yt_"
+
+
+def default_tmp_root() -> str:
+    """Use tmpfs (/dev/shm) for downloads when it's big enough to be useful:
+    ffmpeg merges then run at memory speed. Docker's default /dev/shm is only
+    64 MB, so small ones fall back to the normal temp dir."""
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and shutil.disk_usage(shm).total >= 2 * 1024 ** 3:
+        return shm
+    return tempfile.gettempdir()
+
+
+# Where downloads are written; override with YTDL_TMPDIR
+TMP_ROOT = os.environ.get("YTDL_TMPDIR") or default_tmp_root()
+# New jobs are refused (503) while TMP_ROOT has less free space than this (MB)
+MIN_FREE_MB = int(os.environ.get("YTDL_MIN_FREE_MB", "512"))
+
+
+# ---------- Job state ----------
+
+class JobStore:
+    """In-process progress state: job_id -> dict(status, percent, speed, eta, msg,
+    tmpdir, final_path, error, filename).
+
+    Also maps in-flight downloads (mode + URL) to their job so identical
+    requests can share one download.
+
+    Worker threads, progress hooks and request threads all touch the same jobs,
+    so every access goes through one lock and readers only ever get copies."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._active = {}  # "mode:url" -> job_id
+        self._lock = threading.RLock()
+        self._changed = {}  # job_id -> Condition, so waiters only wake for their job
+
+    def create(self, job_id: str, fields: dict):
+        with self._lock:
+            self._jobs[job_id] = dict(fields)
+            self._changed[job_id] = threading.Condition(self._lock)
+
+    def get(self, job_id: str):
+        """Return a copy of the job's fields, or None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def set_fields(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+                self._changed[job_id].notify_all()
+
+    def wait_for_update(self, job_id: str, seen_etag: str, timeout: float):
+        """Block until the job no longer matches `seen_etag` (updated or deleted),
+        or the timeout passes. The check and the wait happen under one lock, so
+        an update right before the wait isn't missed."""
+        with self._lock:
+            changed = self._changed.get(job_id)
+            if changed is not None and progress_etag(self._jobs[job_id]) == seen_etag:
+                changed.wait(timeout)
+
+    def delete(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            changed = self._changed.pop(job_id, None)
+            if changed is not None:
+                changed.notify_all()
+
+    def job_ids(self) -> list:
+        with self._lock:
+            return list(self._jobs)
+
+    def active_job(self, key: str):
+        with self._lock:
+            return self._active.get(key)
+
+    def set_active(self, key: str, job_id: str):
+        with self._lock:
+            self._active[key] = job_id
+
+    def release_active(self, key: str, job_id: str):
+        with self._lock:
+            if self._active.get(key) == job_id:
+                del self._active[key]
+
+
+class RedisJobStore:
+    """Progress state in one Redis hash per job, shared by all worker processes.
+    Field values are JSON-encoded; keys expire after JOB_TTL seconds."""
+
+    # Update only jobs that still exist, so a late progress hook can't
+    # resurrect a job that was already fetched and deleted.
+    _SET_IF_EXISTS = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+    end
+    """
+    _RELEASE_ACTIVE = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+    end
+    """
+
+    def __init__(self, url: str, ttl: int = JOB_TTL):
+        import redis  # optional dependency, only needed with REDIS_URL
+        self._r = redis.Redis.from_url(url)
+        self._ttl = ttl
+        self._set_if_exists = self._r.register_script(self._SET_IF_EXISTS)
+        self._release_active = self._r.register_script(self._RELEASE_ACTIVE)
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"ytdl:job:{job_id}"
+
+    @staticmethod
+    def _active_key(key: str) -> str:
+        return "ytdl:active:" + hashlib.sha1(key.encode()).hexdigest()
+
+    def create(self, job_id: str, fields: dict):
+        key = self._key(job_id)
+        pipe = self._r.pipeline()
+        pipe.hset(key, mapping={k: json.dumps(v) for k, v in fields.items()})
+        pipe.expire(key, self._ttl)
+        pipe.execute()
+
+    def get(self, job_id: str):
+        raw = self._r.hgetall(self._key(job_id))
+        if not raw:
+            return None
+        return {k.decode(): json.loads(v) for k, v in raw.items()}
+
+    def set_fields(self, job_id: str, **fields):
+        args = [self._ttl]
+        for k, v in fields.items():
+            args += [k, json.dumps(v)]
+        self._set_if_exists(keys=[self._key(job_id)], args=args)
+
+    def wait_for_update(self, job_id: str, seen_etag: str, timeout: float):
+        # Updates may come from other processes; callers re-check after a short nap
+        time.sleep(min(timeout, 0.25))
+
+    def delete(self, job_id: str):
+        self._r.delete(self._key(job_id))
+
+    def job_ids(self) -> list:
+        prefix = len(self._key(""))
+        return [k.decode()[prefix:] for k in self._r.scan_iter(match=self._key("*"))]
+
+    def active_job(self, key: str):
+        job_id = self._r.get(self._active_key(key))
+        return job_id.decode() if job_id else None
+
+    def set_active(self, key: str, job_id: str):
+        self._r.set(self._active_key(key), job_id, ex=self._ttl)
+
+    def release_active(self, key: str, job_id: str):
+        self._release_active(keys=[self._active_key(key)], args=[job_id])
+
+
+STORE = RedisJobStore(REDIS_URL) if REDIS_URL else JobStore()
+
+_pending = 0
+_running = set()  # job ids submitted by this process and not done yet
+_pending_lock = threading.Lock()
+
+
+def has_free_space() -> bool:
+    return shutil.disk_usage(TMP_ROOT).free >= MIN_FREE_MB * 1024 ** 2
+
+
+def try_reserve_slot() -> bool:
+    """Count a new job against YTDL_MAX_PENDING; False if the queue is full."""
+    global _pending
+    with _pending_lock:
+        if _pending >= YTDL_MAX_PENDING:
+            return False
+        _pending += 1
+        return True
+
+
+def release_slot():
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+def expire_jobs():
+    """Drop jobs nobody fetched and delete their downloads. Also removes
+    download dirs no job refers to anymore (e.g. after a restart)."""
+    now = time.time()
+    in_use = set()
+    for job_id in STORE.job_ids():
+        job = STORE.get(job_id)
+        if not job:
+            continue
+        ended = job.get("ended_at")
+        if ended:
+            expired = now - ended > DONE_TTL
+        else:
+            # Queued/running jobs are kept alive by their owner's heartbeat
+            expired = now - job["updated_at"] > JOB_TTL
+        if expired:
+            if job["tmpdir"]:
+                shutil.rmtree(job["tmpdir"], ignore_errors=True)
+            STORE.delete(job_id)
+        elif job["tmpdir"]:
+            in_use.add(job["tmpdir"])
+
+    with os.scandir(TMP_ROOT) as it:
+        for entry in it:
+            if (entry.name.startswith(TMP_PREFIX) and entry.path not in in_use
+                    and entry.is_dir(follow_symlinks=False)
+                    and now - entry.stat().st_mtime > JOB_TTL):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def heartbeat():
+    """Mark the jobs this process is queueing or running as alive."""
+    now = time.time()
+    with _pending_lock:
+        job_ids = list(_running)
+    for job_id in job_ids:
+        STORE.set_fields(job_id, updated_at=now)
+
+
+def janitor():
+    last_expire = time.monotonic()
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            heartbeat()
+            if time.monotonic() - last_expire >= JANITOR_INTERVAL:
+                last_expire = time.monotonic()
+                expire_jobs()
+        except Exception:
+            # Never let a cleanup error kill the janitor thread
+            pass
+
+
+if IS_MAIN_PROCESS:
+    threading.Thread(target=janitor, name="janitor", daemon=True).start()
 
 
 # ---------- Utilities ----------
 
+@functools.lru_cache(maxsize=1)
 def have_ffmpeg() -> bool:
-    """Return True if ffmpeg/ffprobe are available either via env var or PATH."""
+    """Return True if ffmpeg/ffprobe are available either via env var or PATH.
+    Probed once per process; restart the app after installing ffmpeg."""
     loc = os.environ.get("FFMPEG_LOCATION")
     if loc:
         # Accept a directory or a direct path to the binary
@@ -67,7 +427,7 @@ def have_ffmpeg() -> bool:
 
 def make_job() -> str:
     job_id = uuid.uuid4().hex[:12]
-    PROGRESS[job_id] = {
+    STORE.create(job_id, {
         "status": "queued",
         "percent": 0.0,
         "speed": None,
@@ -77,52 +437,20 @@ def make_job() -> str:
         "final_path": None,
         "filename": None,
         "error": None,
-    }
+        "created_at": time.time(),
+        "updated_at": time.time(),
+        "ended_at": None,
+    })
     return job_id
 
 
-def build_opts(tmpdir: str, mode: str, job_id: str) -> dict:
-    """
-    Build yt-dlp options based on mode and whether ffmpeg is available.
-    Modes:
-      - best: highest quality (needs ffmpeg for top tiers; else fallback to progressive)
-      - progressive: single-file MP4 (≤1080p), no ffmpeg needed
-      - audio: best audio; MP3 if ffmpeg present, else original container (m4a/webm)
-    """
-    ff = have_ffmpeg()
-    ff_loc = os.environ.get("FFMPEG_LOCATION")  # optional
-    player_clients = [c.strip() for c in YTDLP_PLAYER_CLIENT.split(",") if c.strip()]
+MODES = ("best", "progressive", "audio")
+OUTTMPL = "%(title)s.%(ext)s"
 
-    def hook(d):
-        job = PROGRESS.get(job_id)
-        if not job:
-            return
-        st = d.get("status")
-        if st == "downloading":
-            total = d.get("total_bytes") or d.get("total_bytes_estimate")
-            downloaded = d.get("downloaded_bytes") or 0
-            percent = (downloaded / total) * 100 if total else 0.0
-            job["status"] = "downloading"
-            job["percent"] = round(percent, 2)
-            job["speed"] = d.get("speed")  # bytes/sec
-            job["eta"] = d.get("eta")      # seconds
-            job["msg"] = d.get("_filename") or "Downloading..."
-            job["filename"] = os.path.basename(d.get("filename") or job.get("filename") or "")
-        elif st == "finished":
-            job["status"] = ("postprocessing" if (ff and mode in ("best", "audio"))
-                             else "finalizing")
-            job["msg"] = "Merging / finalizing..."
-            job["filename"] = os.path.basename(d.get("filename") or job.get("filename") or "")
 
-    ydl_opts = {
-        "outtmpl": os.path.join(tmpdir, "%(title)s.%(ext)s"),
-        "progress_hooks": [hook],
-        "quiet": True,
-        "noprogress": True,
-        "extractor_args": {"youtube": {"player_client": player_clients}},
-    }
-    if ff_loc:
-        ydl_opts["ffmpeg_location"] = ff_loc  # tell yt-dlp where ffmpeg/ffprobe are
+def cookie_opts() -> dict:
+    """yt-dlp cookie options from the server-side config. Computed once at import."""
+    ydl_opts = {}
     # If a server-side cookies file exists, use it automatically (users won't be asked)
     if COOKIES_FILE and os.path.exists(COOKIES_FILE):
         ydl_opts["cookiefile"] = COOKIES_FILE
@@ -146,87 +474,454 @@ def build_opts(tmpdir: str, mode: str, job_id: str) -> dict:
         except Exception:
             # Ignore parsing errors and proceed without browser cookies
             pass
+    return ydl_opts
+
+
+_COOKIES_OPT = cookie_opts()
+
+
+def base_opts() -> dict:
+    """yt-dlp options shared by every job. Computed once at import."""
+    player_clients = [c.strip() for c in YTDLP_PLAYER_CLIENT.split(",") if c.strip()]
+    ff_loc = os.environ.get("FFMPEG_LOCATION")  # optional
+
+    ydl_opts = {
+        "quiet": True,
+        "noprogress": True,
+        "extractor_args": {"youtube": {"player_client": player_clients}},
+    }
+    if ff_loc:
+        ydl_opts["ffmpeg_location"] = ff_loc  # tell yt-dlp where ffmpeg/ffprobe are
+    ydl_opts.update(_COOKIES_OPT)
+    return ydl_opts
 
+
+_BASE_OPTS = base_opts()
+
+
+@functools.lru_cache(maxsize=len(MODES) * 2)
+def mode_opts(mode: str, ff: bool) -> dict:
+    """
+    Format/postprocessing options for a mode, depending on whether ffmpeg is available.
+    Modes:
+      - best: highest quality (needs ffmpeg for top tiers; else fallback to progressive)
+      - progressive: single-file MP4 (≤1080p), no ffmpeg needed
+      - audio: best audio; MP3 if ffmpeg present, else original container (m4a/webm)
+    """
     if mode == "audio":
         if ff:
             # Convert to MP3 via ffmpeg
-            ydl_opts.update({
+            return {
                 "format": "ba/best",
                 "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "mp3"}],
                 "merge_output_format": "mp3",
-            })
+            }
         else:
             # No ffmpeg: just fetch best audio as-is (m4a/webm)
-            ydl_opts.update({
+            return {
                 "format": "ba/best",
-            })
+            }
 
     elif mode == "progressive":
         # Single MP4 (video+audio together). No merge required.
-        ydl_opts.update({
+        return {
             "format": "b[ext=mp4]/best",
             "merge_output_format": "mp4",
-        })
+        }
 
     else:  # mode == "best"
         if ff:
             # Separate best video+audio, then ffmpeg merges → highest quality
-            ydl_opts.update({
+            return {
                 "format": "bv*+ba/best",
                 "merge_output_format": "mp4",
-            })
+            }
         else:
             # No ffmpeg: fallback to progressive MP4 to avoid merge errors
-            ydl_opts.update({
+            return {
                 "format": "b[ext=mp4]/best",
                 "merge_output_format": "mp4",
-            })
+            }
 
-    return ydl_opts
 
+def build_opts(mode: str) -> dict:
+    """yt-dlp options for a mode: shared base + mode overlay. Output path and
+    progress hook are per job and set by YdlPool.checkout()."""
+    return {
+        **_BASE_OPTS,
+        **mode_opts(mode, have_ffmpeg()),
+        "outtmpl": OUTTMPL,
+    }
+
+
+def make_progress_hook(mode: str, job_id: str):
+    """yt-dlp progress hook that reports into the job's progress state."""
+    # The hook runs for every downloaded chunk: resolve what we can up front
+    # and keep lookups local.
+    finished_status = ("postprocessing" if (have_ffmpeg() and mode in ("best", "audio"))
+                       else "finalizing")
+    basename = os.path.basename
+    monotonic = time.monotonic
+    last_update = 0.0
+    last_filename = None
+
+    def hook(d):
+        # One batched update per callback (a single round trip with Redis)
+        nonlocal last_update, last_filename
+        get = d.get
+        st = get("status")
+        if st == "downloading":
+            total = get("total_bytes") or get("total_bytes_estimate")
+            downloaded = get("downloaded_bytes") or 0
+            now = monotonic()
+            # Skip intermediate chunks; always report the last one of a file
+            if now - last_update < PROGRESS_INTERVAL and not (total and downloaded >= total):
+                return
+            last_update = now
+            percent = (downloaded / total) * 100 if total else 0.0
+            fields = {
+                "status": "downloading",
+                "percent": round(percent, 2),
+                "speed": get("speed"),  # bytes/sec
+                "eta": get("eta"),      # seconds
+                "msg": get("_filename") or "Downloading...",
+            }
+        elif st == "finished":
+            fields = {
+                "status": finished_status,
+                "msg": "Merging / finalizing...",
+            }
+        else:
+            return
+        # Only send the filename when yt-dlp moves on to another file
+        raw_filename = get("filename")
+        if raw_filename and raw_filename != last_filename:
+            last_filename = raw_filename
+            fields["filename"] = basename(raw_filename)
+        report(job_id, **fields)
+
+    return hook
+
+
+def cookies_mtime():
+    """Modification time of the cookies file in use, or None."""
+    try:
+        return os.stat(_COOKIES_OPT["cookiefile"]).st_mtime_ns
+    except (KeyError, OSError):
+        return None
+
+
+class YdlPool:
+    """Idle YoutubeDL instances per mode, reused across jobs.
+
+    Creating a YoutubeDL sets up extractors, the cookie jar and an HTTP
+    connection pool; reusing one saves that on every job. Options only differ
+    per job in the output template and progress hook, which are swapped on
+    checkout. An instance is used by one job at a time, so there are never
+    more instances than concurrent downloads.
+
+    Pooled instances never write their cookie jar back to COOKIES_FILE: an
+    old in-memory jar would overwrite a cookies.txt the operator replaced.
+    Instead the jar is reloaded on checkout when the file has changed."""
+
+    def __init__(self):
+        self._idle = {}  # mode -> [(ydl, slot)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create(mode: str):
+        ydl = YoutubeDL(build_opts(mode))
+        # The hook registered with yt-dlp is fixed; it forwards to the current job's hook
+        slot = {"hook": None, "cookies_mtime": cookies_mtime()}
+        ydl.add_progress_hook(lambda d: slot["hook"](d))
+        return ydl, slot
 
-def resolve_final_path(tmpdir: str, ydl: YoutubeDL, info: dict) -> str:
+    @staticmethod
+    def _refresh_cookies(ydl, slot):
+        mtime = cookies_mtime()
+        if mtime == slot["cookies_mtime"] or mtime is None:
+            return
+        # Load into a fresh jar first: if the file is unreadable or half-written,
+        # keep the cookies we have and try again on the next checkout
+        fresh = YoutubeDLCookieJar(_COOKIES_OPT["cookiefile"])
+        try:
+            fresh.load()
+        except (http.cookiejar.LoadError, OSError):
+            return
+        # Swap the contents, not the object: yt-dlp's HTTP handlers hold the jar
+        ydl.cookiejar.clear()
+        for cookie in fresh:
+            ydl.cookiejar.set_cookie(cookie)
+        slot["cookies_mtime"] = mtime
+
+    @staticmethod
+    def _discard(ydl):
+        # close() would save the jar over COOKIES_FILE; skip that
+        ydl.params.pop("cookiefile", None)
+        ydl.close()
+
+    @contextlib.contextmanager
+    def checkout(self, mode: str, tmpdir: str, hook):
+        mode = mode if mode in MODES else "best"
+        with self._lock:
+            idle = self._idle.get(mode)
+            entry = idle.pop() if idle else None
+        ydl, slot = entry or self._create(mode)
+        ydl.params["outtmpl"]["default"] = os.path.join(tmpdir, OUTTMPL)
+        slot["hook"] = hook
+        reusable = False
+        try:
+            if entry:
+                self._refresh_cookies(ydl, slot)
+            yield ydl
+            reusable = True
+        except DownloadError:
+            reusable = True  # ordinary per-video failure; the instance is fine
+            raise
+        finally:
+            slot["hook"] = lambda d: None
+            if reusable:
+                with self._lock:
+                    self._idle.setdefault(mode, []).append((ydl, slot))
+            else:
+                # Don't reuse an instance an unexpected error may have left in a bad state
+                self._discard(ydl)
+
+
+YDL_POOL = YdlPool()
+
+
+def expected_ext(mode: str):
+    """Extension the finished file should have, or None if it depends on the source."""
+    if mode == "audio":
+        return ".mp3" if have_ffmpeg() else None
+    return ".mp4"
+
+
+def resolve_final_path(tmpdir: str, ydl: YoutubeDL, info: dict, mode: str) -> str:
     """Get the final output file path (postprocessing can change the extension)."""
     final_path = ydl.prepare_filename(info)
     if not os.path.exists(final_path):
-        files = [os.path.join(tmpdir, f) for f in os.listdir(tmpdir)]
-        if files:
-            final_path = max(files, key=os.path.getmtime)
+        # One scandir pass; DirEntry caches stat info. Skip partial downloads and
+        # prefer files with the expected extension over leftover streams.
+        with os.scandir(tmpdir) as it:
+            entries = [e for e in it
+                       if e.is_file() and not e.name.endswith((".part", ".ytdl"))]
+        ext = expected_ext(mode)
+        preferred = [e for e in entries if ext and e.name.endswith(ext)]
+        candidates = preferred or entries
+        if candidates:
+            final_path = max(candidates, key=lambda e: e.stat().st_mtime).path
     return final_path
 
 
+_long_poll_slots = threading.BoundedSemaphore(LONG_POLL_CLIENTS)
+
+
+def progress_etag(job: dict) -> str:
+    """ETag over every field /progress reports."""
+    key = "|".join(str(job[k]) for k in
+                   ("status", "percent", "speed", "eta", "msg", "error", "filename"))
+    return hashlib.md5(key.encode()).hexdigest()
+
+
 # ---------- Worker ----------
 
+# Set in download child processes; progress goes to the parent through it
+_progress_queue = None
+
+
+def report(job_id: str, **fields):
+    """Update a job's progress from the download worker."""
+    if _progress_queue is not None:
+        _progress_queue.put((job_id, fields))
+    else:
+        STORE.set_fields(job_id, **fields)
+
+
+def init_download_process(queue):
+    global _progress_queue
+    _progress_queue = queue
+
+
+def drain_progress(queue):
+    """Apply progress updates sent by download processes (runs in the app process)."""
+    while True:
+        job_id, fields = queue.get()
+        STORE.set_fields(job_id, **fields)
+
+
 def download_worker(url: str, mode: str, job_id: str):
-    tmpdir = tempfile.mkdtemp(prefix="yt_")
-    PROGRESS[job_id]["tmpdir"] = tmpdir
-    PROGRESS[job_id]["status"] = "starting"
-    PROGRESS[job_id]["msg"] = "Starting..."
+    tmpdir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=TMP_ROOT)
+    report(job_id, tmpdir=tmpdir, status="starting", msg="Starting...")
 
     try:
-        ydl_opts = build_opts(tmpdir, mode, job_id)
-        with YoutubeDL(ydl_opts) as ydl:
+        hook = make_progress_hook(mode, job_id)
+        with YDL_POOL.checkout(mode, tmpdir, hook) as ydl:
             info = ydl.extract_info(url, download=True)
-            final_path = resolve_final_path(tmpdir, ydl, info)
-            PROGRESS[job_id]["final_path"] = final_path
-            PROGRESS[job_id]["filename"] = os.path.basename(final_path)
-            PROGRESS[job_id]["status"] = "finished"
-            PROGRESS[job_id]["percent"] = 100.0
-            PROGRESS[job_id]["msg"] = "Ready to download"
+            final_path = resolve_final_path(tmpdir, ydl, info, mode)
+            report(
+                job_id,
+                final_path=final_path,
+                filename=os.path.basename(final_path),
+                status="finished",
+                percent=100.0,
+                msg="Ready to download",
+                ended_at=time.time(),
+            )
 
     except DownloadError as e:
-        PROGRESS[job_id]["status"] = "error"
-        PROGRESS[job_id]["error"] = str(e)
-        PROGRESS[job_id]["msg"] = "Download error"
+        report(job_id, status="error", error=str(e), msg="Download error",
+               ended_at=time.time())
 
     except Exception as e:
-        PROGRESS[job_id]["status"] = "error"
-        PROGRESS[job_id]["error"] = str(e)
-        PROGRESS[job_id]["msg"] = "Unexpected error"
+        report(job_id, status="error", error=str(e), msg="Unexpected error",
+               ended_at=time.time())
+
+
+def job_done(job_id: str, active_key: str, executor, future):
+    """Executor callback: free the queue slot, stop coalescing new requests onto
+    this job, and flag it if its worker died."""
+    release_slot()
+    with _pending_lock:
+        _running.discard(job_id)
+    STORE.release_active(active_key, job_id)
+    if not future.cancelled() and future.exception() is not None:
+        STORE.set_fields(job_id, status="error", error=str(future.exception()),
+                         msg="Worker crashed", ended_at=time.time())
+        if isinstance(future.exception(), BrokenProcessPool):
+            replace_broken_executor(executor)
+
+
+# Bounded pool of download workers
+if YTDL_PROCS > 0 and IS_MAIN_PROCESS:
+    _ctx = multiprocessing.get_context("spawn")  # no fork() of a threaded server
+    _queue = _ctx.Queue()
+    threading.Thread(target=drain_progress, args=(_queue,), name="progress", daemon=True).start()
+
+
+def make_executor():
+    if YTDL_PROCS > 0 and IS_MAIN_PROCESS:
+        return ProcessPoolExecutor(max_workers=YTDL_PROCS, mp_context=_ctx,
+                                   initializer=init_download_process, initargs=(_queue,))
+    return ThreadPoolExecutor(max_workers=YTDL_WORKERS, thread_name_prefix="ytdl")
+
+
+EXECUTOR = make_executor()
+_executor_lock = threading.Lock()
+
+
+def replace_broken_executor(broken):
+    """A ProcessPoolExecutor is unusable once any child dies; start a new one."""
+    global EXECUTOR
+    with _executor_lock:
+        if EXECUTOR is broken:
+            EXECUTOR = make_executor()
+            broken.shutdown(wait=False)
+
+
+def submit_download(url: str, mode: str, job_id: str):
+    """Queue a download; returns (executor, future)."""
+    executor = EXECUTOR
+    try:
+        return executor, executor.submit(download_worker, url, mode, job_id)
+    except BrokenProcessPool:
+        replace_broken_executor(executor)
+        executor = EXECUTOR
+        return executor, executor.submit(download_worker, url, mode, job_id)
+
+
+def url_error(url: str):
+    """Why `url` can't be downloaded, or None if it looks fine. Checked before a
+    job is queued so bad input never occupies a download slot."""
+    if not url:
+        return "No URL"
+    if not _URL_RE.match(url):
+        return "Invalid URL"
+    try:
+        host = urlparse(url).hostname
+    except ValueError:  # e.g. an unbalanced "[" in the host
+        return "Invalid URL"
+    if host not in ALLOWED_HOSTS:
+        return "Only YouTube URLs are supported"
+    return None
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a validated URL, so equivalent links (youtu.be/ID,
+    /shorts/ID, extra tracking parameters, ...) share one download job.
+    Single videos become https://www.youtube.com/watch?v=ID."""
+    parts = urlparse(url)
+    host = parts.hostname
+    query = [(k, v) for k, v in parse_qsl(parts.query)
+             if k not in _TRACKING_PARAMS and not k.startswith("utm_")]
+
+    video_id = None
+    if host == "youtu.be":
+        video_id = parts.path.strip("/").split("/")[0]
+    else:
+        match = _VIDEO_PATH_RE.match(parts.path)
+        if match:
+            video_id = match.group(1)
+        elif parts.path == "/watch":
+            video_id = dict(query).get("v")
+    if video_id and _VIDEO_ID_RE.match(video_id):
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    return urlunparse(("https", host, parts.path, "", urlencode(query), ""))
+
+
+# /stream children run outside EXECUTOR, so cap them to the same worker count
+_stream_slots = threading.BoundedSemaphore(YTDL_WORKERS)
+
+
+def needs_merge(mode: str) -> bool:
+    """True if the mode's output is produced by ffmpeg (merge/convert), which
+    needs a seekable file and so can't be streamed while downloading."""
+    return have_ffmpeg() and mode in ("best", "audio")
+
+
+def stream_command(workdir: str, mode: str) -> list:
+    """yt-dlp command line that downloads the video extracted into workdir to stdout."""
+    cmd = [sys.executable, "-m", "yt_dlp", "--quiet", "--no-progress",
+           "--load-info-json", os.path.join(workdir, "info.json"),
+           "-f", mode_opts(mode, False)["format"], "-o", "-"]
+    if "cookiefile" in _COOKIES_OPT:
+        # The child rewrites its cookie file on exit; give it a private copy so
+        # concurrent streams can't truncate the shared cookies.txt
+        cookies_path = os.path.join(workdir, "cookies.txt")
+        shutil.copyfile(_COOKIES_OPT["cookiefile"], cookies_path)
+        cmd += ["--cookies", cookies_path]
+    elif "cookiesfrombrowser" in _COOKIES_OPT:
+        browser, profile = _COOKIES_OPT["cookiesfrombrowser"][:2]
+        cmd += ["--cookies-from-browser", f"{browser}:{profile}" if profile else browser]
+    return cmd
 
 
 # ---------- Routes ----------
 
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=REDIS_URL or "memory://",
+    headers_enabled=True,  # adds Retry-After to 429s
+)
+
+
+def started_download(response) -> bool:
+    """Only requests that actually start a download count against the rate limit
+    (not rejected input, HEAD, or /start hits joining an existing job)."""
+    if response.status_code != 200:
+        return False
+    return not (response.is_json and response.get_json().get("coalesced"))
+
+
+@app.errorhandler(429)
+def too_many_requests(e):
+    # The page expects JSON from /start
+    return jsonify({"ok": False, "error": f"Too many requests ({e.description})"}), 429
+
+
 @app.route("/", methods=["GET"])
 def index():
     # Pass branding to template
@@ -235,38 +930,98 @@ def index():
 
 @app.route("/ffmpeg", methods=["GET"])
 def ffmpeg_status():
-    cookies_file_ok = bool(COOKIES_FILE and os.path.exists(COOKIES_FILE))
     cookies_method = (
-        "file" if cookies_file_ok else ("browser" if COOKIES_FROM_BROWSER else "none")
+        "file" if "cookiefile" in _COOKIES_OPT
+        else ("browser" if "cookiesfrombrowser" in _COOKIES_OPT else "none")
     )
     return jsonify({
         "ok": True,
         "ffmpeg": have_ffmpeg(),
-        "cookies": cookies_file_ok or bool(COOKIES_FROM_BROWSER),
+        "cookies": bool(_COOKIES_OPT),
         "cookies_method": cookies_method,
     })
 
 
 @app.route("/start", methods=["POST"])
+@limiter.shared_limit(START_RATE_LIMIT, scope="downloads", deduct_when=started_download,
+                      exempt_when=lambda: request.method == "HEAD")
 def start():
     # Users only send URL + mode. Cookies (if any) are server-side and automatic.
     data = request.form or request.json or {}
     url = (data.get("url") or "").strip()
     mode = (data.get("mode") or "best").strip()
-    if not url:
-        return jsonify({"ok": False, "error": "No URL"}), 400
+    error = url_error(url)
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+    url = normalize_url(url)
+
+    # Same video + mode already being downloaded: share that job
+    active_key = f"{mode if mode in MODES else 'best'}:{url}"
+    existing = STORE.active_job(active_key)
+    job = STORE.get(existing) if existing else None
+    if job and (job["ended_at"] or time.time() - job["updated_at"] <= STALE_AFTER):
+        return jsonify({"ok": True, "job_id": existing, "coalesced": True})
+    if job:
+        # Its owner died without running job_done; fail it for anyone still polling
+        STORE.set_fields(existing, status="error", error="Download worker stopped",
+                         msg="Worker lost", ended_at=time.time())
+        STORE.release_active(active_key, existing)
+
+    if not has_free_space():
+        return jsonify({"ok": False, "error": "Server storage is full, try again later"}), 503
+    if not try_reserve_slot():
+        resp = jsonify({"ok": False, "error": "Server busy, try again shortly"})
+        return resp, 429, {"Retry-After": str(QUEUE_FULL_RETRY_AFTER)}
 
     job_id = make_job()
-    threading.Thread(target=download_worker, args=(url, mode, job_id), daemon=True).start()
+    STORE.set_active(active_key, job_id)
+    with _pending_lock:
+        _running.add(job_id)
+    try:
+        executor, future = submit_download(url, mode, job_id)
+    except Exception as e:
+        release_slot()
+        with _pending_lock:
+            _running.discard(job_id)
+        STORE.release_active(active_key, job_id)
+        STORE.delete(job_id)
+        return jsonify({"ok": False, "error": f"Download workers unavailable: {e}"}), 503
+    future.add_done_callback(functools.partial(job_done, job_id, active_key, executor))
     return jsonify({"ok": True, "job_id": job_id})
 
 
 @app.route("/progress/<job_id>", methods=["GET"])
 def progress(job_id: str):
-    job = PROGRESS.get(job_id)
-    if not job:
-        return jsonify({"ok": False, "error": "unknown job"}), 404
-    return jsonify({
+    # Clients send If-None-Match with the last ETag they saw. If nothing changed,
+    # hold the request up to ?wait=N seconds for an update, then answer 304.
+    try:
+        wait = min(max(float(request.args.get("wait", 0)), 0.0), LONG_POLL_MAX)
+    except ValueError:
+        wait = 0.0
+    deadline = time.monotonic() + wait
+
+    waiting = False
+    try:
+        while True:
+            job = STORE.get(job_id)
+            if not job:
+                return jsonify({"ok": False, "error": "unknown job"}), 404
+            etag = progress_etag(job)
+            if not request.if_none_match.contains(etag):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining > 0 and not waiting:
+                waiting = _long_poll_slots.acquire(blocking=False)
+            if remaining <= 0 or not waiting:
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                return resp
+            STORE.wait_for_update(job_id, etag, remaining)
+    finally:
+        if waiting:
+            _long_poll_slots.release()
+
+    resp = jsonify({
         "ok": True,
         "status": job["status"],
         "percent": job["percent"],
@@ -276,33 +1031,129 @@ def progress(job_id: str):
         "error": job["error"],
         "filename": job["filename"],
     })
+    resp.set_etag(etag)
+    return resp
 
 
 @app.route("/fetch/<job_id>", methods=["GET"])
 def fetch(job_id: str):
-    job = PROGRESS.get(job_id)
+    job = STORE.get(job_id)
     if not job:
         return "Unknown job", 404
     if job["status"] != "finished" or not job["final_path"]:
         return "Not ready", 409
 
     final_path = job["final_path"]
-    tmpdir = job["tmpdir"]
     filename = os.path.basename(final_path)
 
-    @after_this_request
-    def cleanup(resp):
+    # The file is kept after a fetch so interrupted downloads can resume with
+    # Range requests and coalesced clients can fetch it too; the janitor
+    # deletes it DONE_TTL after the job ended.
+    # conditional=True enables Range/If-Modified-Since; the file body goes out
+    # through the server's file wrapper (sendfile under gunicorn)
+    return send_file(final_path, as_attachment=True, download_name=filename,
+                     conditional=True, max_age=0)
+
+
+@app.route("/stream", methods=["GET"])
+@limiter.shared_limit(START_RATE_LIMIT, scope="downloads", deduct_when=started_download,
+                      exempt_when=lambda: request.method == "HEAD")
+def stream():
+    """
+    One-step download: send the file to the client while yt-dlp is still
+    fetching it, instead of /start + /progress + /fetch. Only for single-file
+    formats; modes that need an ffmpeg merge must use /start.
+    """
+    if request.method == "HEAD":
+        # Flask routes HEAD here too; don't start a download just to drop the body
+        return jsonify({"ok": False, "error": "Use GET"}), 405, {"Allow": "GET"}
+    url = (request.args.get("url") or "").strip()
+    mode = (request.args.get("mode") or "progressive").strip()
+    mode = mode if mode in MODES else "best"
+    error = url_error(url)
+    if error:
+        return jsonify({"ok": False, "error": error}), 400
+    url = normalize_url(url)
+    if needs_merge(mode):
+        return jsonify({"ok": False, "error": f"Mode '{mode}' needs ffmpeg; use /start"}), 409
+    if not has_free_space():
+        return jsonify({"ok": False, "error": "Server storage is full, try again later"}), 503
+    if not _stream_slots.acquire(blocking=False):
+        resp = jsonify({"ok": False, "error": "Server busy, try again shortly"})
+        return resp, 429, {"Retry-After": str(QUEUE_FULL_RETRY_AFTER)}
+    if not try_reserve_slot():
+        _stream_slots.release()
+        resp = jsonify({"ok": False, "error": "Server busy, try again shortly"})
+        return resp, 429, {"Retry-After": str(QUEUE_FULL_RETRY_AFTER)}
+
+    workdir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=TMP_ROOT)
+    proc = None
+    cleanup_once = threading.Lock()
+
+    def cleanup():
+        # Runs from the generator and from the response's close(); only once
+        if not cleanup_once.acquire(blocking=False):
+            return
+        if proc:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+        release_slot()
+        _stream_slots.release()
+
+    try:
+        # Extract once here for the filename; the child reuses the info instead of
+        # extracting again
+        with YDL_POOL.checkout(mode, workdir, lambda d: None) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            filename = os.path.basename(ydl.prepare_filename(info))
+        with open(os.path.join(workdir, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+
+        proc = subprocess.Popen(stream_command(workdir, mode),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # Read the first block before answering so a failed download is still an error
+        first = proc.stdout.read(STREAM_CHUNK)
+        if not first:
+            proc.wait()
+            cleanup()
+            return jsonify({"ok": False, "error": "Download failed"}), 502
+    except DownloadError as e:
+        cleanup()
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception:
+        cleanup()
+        raise
+
+    def generate():
         try:
-            shutil.rmtree(tmpdir, ignore_errors=True)
-        except Exception:
-            pass
-        PROGRESS.pop(job_id, None)  # free memory
-        return resp
+            chunk = first
+            while chunk:
+                yield chunk
+                chunk = proc.stdout.read(STREAM_CHUNK)
+        finally:
+            cleanup()
 
-    return send_file(final_path, as_attachment=True, download_name=filename)
+    resp = Response(generate(), mimetype="application/octet-stream")
+    # The generator's finally doesn't run if it is closed before it starts
+    # (client gone before the first chunk)
+    resp.call_on_close(cleanup)
+    resp.headers["Content-Disposition"] = (
+        f"attachment; filename=\"{filename.encode('ascii', 'replace').decode()}\"; "
+        f"filename*=UTF-8''{quote(filename)}"
+    )
+    return resp
 
 
 if __name__ == "__main__":
-    # For local dev / Docker / PaaS
+    # For local runs. In Docker/PaaS the app is served by gunicorn (see DockerFile).
     port = int(os.environ.get("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    try:
+        # Multi-threaded production server; also works on Windows where gunicorn doesn't
+        from waitress import serve
+    except ImportError:
+        app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
+    else:
+        serve(app, host="0.0.0.0", port=port, threads=16)